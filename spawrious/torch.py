@@ -1,16 +1,28 @@
+import copy
+import functools
+import hashlib
+import io
+import json
+import math
 import os
+import shutil
+import subprocess
 import tarfile
+import tempfile
+import threading
 import urllib
+import urllib.parse
 import urllib.request
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any, Tuple
 
+import numpy as np
 import torch
 from PIL import Image
-from torch.utils.data import ConcatDataset, Dataset
-from torchvision import transforms
-from torchvision.datasets import ImageFolder
-from tqdm import tqdm
-import timm
+from torch import nn
+from torch.nn import functional as F
+from torch.utils.data import Dataset
 from PIL import ImageFile
 
 ImageFile.LOAD_TRUNCATED_IMAGES = True
@@ -34,19 +46,238 @@ def _extract_dataset_from_tar(
 ) -> None:
     tar_file_dst = os.path.join(data_dir, tar_file_name)
     print("Extracting dataset...")
-    tar = tarfile.open(tar_file_dst, "r:gz")
-    tar.extractall(os.path.dirname(tar_file_dst))
-    tar.close()
+    # prefer the native tar binary over the per-member Python overhead of tarfile
+    if shutil.which("tar") is not None:
+        subprocess.run(
+            ["tar", "-xzf", tar_file_dst, "-C", os.path.dirname(tar_file_dst)],
+            check=True,
+        )
+    else:
+        tar = tarfile.open(tar_file_dst, "r:gz")
+        tar.extractall(os.path.dirname(tar_file_dst))
+        tar.close()
     print("Dataset extracted. Delete tar file.")
     if remove_tar_after_extracting:
         os.remove(tar_file_dst)
 
 
+def _download_range(
+    url: str,
+    fd: int,
+    start: int,
+    end: int,
+    progress_bar,
+    lock: threading.Lock,
+    stop: threading.Event,
+) -> None:
+    request = urllib.request.Request(
+        url, headers={"Range": f"bytes={start}-{end - 1}"}
+    )
+    block_size = 1 << 20
+    offset = start
+    with urllib.request.urlopen(request) as response:
+        if response.status != 206:
+            raise RuntimeError(
+                f"Server ignored range request for bytes {start}-{end - 1}"
+            )
+        content_range = response.headers.get("Content-Range", "")
+        if not content_range.startswith(f"bytes {start}-{end - 1}/"):
+            raise RuntimeError(
+                f"Server returned range {content_range!r} for bytes {start}-{end - 1}"
+            )
+        while not stop.is_set():
+            buffer = response.read(min(block_size, end - offset))
+            if not buffer:
+                break
+            os.pwrite(fd, buffer, offset)
+            offset += len(buffer)
+            with lock:
+                progress_bar.update(len(buffer))
+    # read() returns b"" rather than raising when the connection closes early
+    if not stop.is_set() and offset != end:
+        raise RuntimeError(
+            f"Download of bytes {start}-{end - 1} ended early at byte {offset}"
+        )
+
+
+def _download_ranges(
+    url: str, file_dst: str, total_size: int, num_connections: int, progress_bar
+) -> None:
+    chunk_size = -(-total_size // num_connections)
+    lock = threading.Lock()
+    # set when a range fails, so that the other workers stop instead of finishing their ranges
+    stop = threading.Event()
+    fd = os.open(file_dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        if hasattr(os, "posix_fallocate"):
+            os.posix_fallocate(fd, 0, total_size)
+        else:
+            os.ftruncate(fd, total_size)
+        with ThreadPoolExecutor(max_workers=num_connections) as executor:
+            futures = [
+                executor.submit(
+                    _download_range,
+                    url,
+                    fd,
+                    start,
+                    min(start + chunk_size, total_size),
+                    progress_bar,
+                    lock,
+                    stop,
+                )
+                for start in range(0, total_size, chunk_size)
+            ]
+            try:
+                for future in futures:
+                    future.result()
+            except BaseException:
+                stop.set()
+                for future in futures:
+                    future.cancel()
+                raise
+    finally:
+        os.close(fd)
+
+
+def _download_file(url: str, file_dst: str, num_connections: int = 8) -> None:
+    """
+    Downloads url to file_dst. If the server accepts range requests, the file is split into num_connections byte ranges that are fetched in parallel and written into a preallocated file. The data is written to a .part file that is only renamed to file_dst once the download is complete.
+    """
+    from tqdm import tqdm
+
+    part_file_dst = file_dst + ".part"
+    response = urllib.request.urlopen(url)
+    total_size = int(response.headers.get("Content-Length", 0))
+    accepts_ranges = response.headers.get("Accept-Ranges", "").lower() == "bytes"
+    # Track progress of download
+    progress_bar = tqdm(total=total_size, unit="iB", unit_scale=True)
+    try:
+        if (
+            num_connections > 1
+            and accepts_ranges
+            and total_size > 0
+            and hasattr(os, "pwrite")
+        ):
+            # range requests go to the final url, after any redirects
+            url = response.geturl()
+            response.close()
+            _download_ranges(
+                url, part_file_dst, total_size, num_connections, progress_bar
+            )
+        else:
+            block_size = 1 << 20
+            downloaded = 0
+            with response, open(part_file_dst, "wb", buffering=1 << 20) as f:
+                while True:
+                    buffer = response.read(block_size)
+                    if not buffer:
+                        break
+                    f.write(buffer)
+                    downloaded += len(buffer)
+                    progress_bar.update(len(buffer))
+            if total_size > 0 and downloaded != total_size:
+                raise RuntimeError(
+                    f"Download ended early after {downloaded} of {total_size} bytes"
+                )
+    finally:
+        progress_bar.close()
+    os.replace(part_file_dst, file_dst)
+
+
+class _ProgressReader(io.RawIOBase):
+    """
+    Wraps a raw stream and reports the number of bytes read to a progress bar
+    """
+
+    def __init__(self, raw, progress_bar):
+        self.raw = raw
+        self.progress_bar = progress_bar
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        n = self.raw.readinto(b)
+        self.progress_bar.update(n)
+        return n
+
+
+def _download_and_extract(url: str, data_dir: str) -> None:
+    """
+    Streams the tarball at url straight into tarfile, so that decompression and extraction overlap with the download and the tarball is never written to disk.
+    """
+    from tqdm import tqdm
+
+    # removed only once extraction completes, so that an interrupted extraction is redone
+    marker_file = _incomplete_marker(data_dir, url)
+    open(marker_file, "w").close()
+    with urllib.request.urlopen(url) as response:
+        total_size = int(response.headers.get("Content-Length", 0))
+        # Track progress of download
+        progress_bar = tqdm(total=total_size, unit="iB", unit_scale=True)
+        try:
+            reader = io.BufferedReader(
+                _ProgressReader(response, progress_bar), buffer_size=1 << 20
+            )
+            with tarfile.open(fileobj=reader, mode="r|gz") as tar:
+                tar.extractall(data_dir)
+        except (OSError, EOFError, tarfile.TarError, zlib.error) as e:
+            raise RuntimeError(
+                f"Downloading and extracting {url} failed partway: {e}. "
+                f"The dataset in {data_dir} is incomplete and will be downloaded "
+                "again on the next run."
+            ) from e
+        finally:
+            progress_bar.close()
+    os.remove(marker_file)
+
+
+def _incomplete_marker(data_dir: str, url: str) -> str:
+    tar_file_name = os.path.basename(urllib.parse.urlparse(url).path)
+    return os.path.join(data_dir, f"{tar_file_name}.incomplete")
+
+
+# extracted datasets per data_dir, read from manifest.json once per process
+_manifest_cache = {}
+
+
+def _read_extracted_datasets(data_dir: str) -> set:
+    data_dir = os.path.abspath(data_dir)
+    if data_dir not in _manifest_cache:
+        manifest_file = os.path.join(data_dir, "manifest.json")
+        # datasets.txt is the line-based format used before manifest.json
+        legacy_file = os.path.join(data_dir, "datasets.txt")
+        extracted = set()
+        if os.path.exists(manifest_file):
+            with open(manifest_file) as f:
+                extracted = set(json.load(f).get("extracted", []))
+        elif os.path.exists(legacy_file):
+            with open(legacy_file) as f:
+                extracted = {line.strip() for line in f if line.strip()}
+        _manifest_cache[data_dir] = extracted
+    return _manifest_cache[data_dir]
+
+
+def _record_extracted_dataset(data_dir: str, dataset_name: str) -> None:
+    extracted = _read_extracted_datasets(data_dir)
+    extracted.add(dataset_name)
+    manifest_file = os.path.join(data_dir, "manifest.json")
+    # write to a unique temporary file and rename it, so that manifest.json is never left
+    # half written; the manifest is only a shortcut, so failing to write it is not an error
+    try:
+        fd, tmp_file = tempfile.mkstemp(dir=data_dir, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump({"extracted": sorted(extracted)}, f)
+        os.replace(tmp_file, manifest_file)
+    except OSError as e:
+        print(f"Could not update {manifest_file}: {e}")
+
+
 def _download_dataset_if_not_available(
     dataset_name: str, data_dir: str, remove_tar_after_extracting: bool = True
 ) -> None:
     """
-    datasets.txt file, which is present in the data_dir, is used to check if the dataset is already extracted. If the dataset is already extracted, then the tar file is not downloaded again.
+    manifest.json file, which is present in the data_dir, is used to check if the dataset is already extracted. If the dataset is already extracted, then the tar file is not downloaded again.
     """
     data_dir = data_dir.split("/spawrious224/")[
         0
@@ -67,7 +298,18 @@ def _download_dataset_if_not_available(
     url = url_dict[dataset_name]
 
     # check if the dataset is already extracted
-    if _check_images_availability(data_dir, dataset_name):
+    extracted_datasets = _read_extracted_datasets(data_dir)
+    if (
+        dataset_name in extracted_datasets or "entire_dataset" in extracted_datasets
+    ) and os.path.isdir(os.path.join(data_dir, "spawrious224")):
+        print("Dataset already downloaded and extracted.")
+        return
+    # datasets extracted before the manifest was written are found by scanning for their images,
+    # unless a streamed extraction of this dataset was interrupted. This only checks for one
+    # image per folder, so the result is not recorded in the manifest.
+    elif not os.path.exists(
+        _incomplete_marker(data_dir, url)
+    ) and _check_images_availability(data_dir, dataset_name):
         print("Dataset already downloaded and extracted.")
         return
     # check if the tar file is already downloaded
@@ -77,28 +319,37 @@ def _download_dataset_if_not_available(
             _extract_dataset_from_tar(
                 tar_file_name, data_dir, remove_tar_after_extracting
             )
-            return
+        # the tar file is not kept, so extract it while it downloads
+        elif remove_tar_after_extracting:
+            print("Dataset not found. Downloading and extracting...")
+            _download_and_extract(url, data_dir)
+            print("Dataset extracted.")
         # download the tar file and extract from it
         else:
             print("Dataset not found. Downloading...")
-            response = urllib.request.urlopen(url)
-            total_size = int(response.headers.get("Content-Length", 0))
-            block_size = 1024
-            # Track progress of download
-            progress_bar = tqdm(total=total_size, unit="iB", unit_scale=True)
-            with open(tar_file_dst, "wb") as f:
-                while True:
-                    buffer = response.read(block_size)
-                    if not buffer:
-                        break
-                    f.write(buffer)
-                    progress_bar.update(len(buffer))
-            progress_bar.close()
+            _download_file(url, tar_file_dst)
             print("Dataset downloaded. Extracting...")
             _extract_dataset_from_tar(
                 tar_file_name, data_dir, remove_tar_after_extracting
             )
-            return
+        _record_extracted_dataset(data_dir, dataset_name)
+        return
+
+
+@functools.lru_cache(maxsize=None)
+def _scan_image_names(folder_path: str, mtime_ns: int) -> Tuple[str, ...]:
+    """
+    Lists the image files in a folder. Results are memoized in memory, keyed by the folder path and its modification time so that a changed folder is scanned again.
+    """
+    return tuple(
+        img
+        for img in os.listdir(folder_path)
+        if img.endswith((".png", ".jpg", ".jpeg"))
+    )
+
+
+def _list_image_names(folder_path: str) -> Tuple[str, ...]:
+    return _scan_image_names(folder_path, os.stat(folder_path).st_mtime_ns)
 
 
 class CustomImageFolder(Dataset):
@@ -107,18 +358,25 @@ class CustomImageFolder(Dataset):
     """
 
     def __init__(
-        self, folder_path, class_index, location_index, limit=None, transform=None
+        self,
+        folder_path,
+        class_index,
+        location_index,
+        limit=None,
+        transform=None,
     ):
         self.folder_path = folder_path
         self.class_index = class_index
         self.location_index = location_index
-        self.image_paths = [
-            os.path.join(folder_path, img)
-            for img in os.listdir(folder_path)
-            if img.endswith((".png", ".jpg", ".jpeg"))
-        ]
+        # Select on file names only, so the limit is applied before any path is built
+        image_names = _list_image_names(folder_path)
         if limit:
-            self.image_paths = self.image_paths[:limit]
+            image_names = image_names[:limit]
+        # Paths are kept in one numpy string array rather than a list of str objects,
+        # so that reading them in forked DataLoader workers does not touch refcounts
+        # and copy the pages holding them.
+        prefix = os.path.join(folder_path, "")
+        self.image_paths = np.char.add(prefix, np.array(image_names, dtype=str))
         self.transform = transform
 
     def __len__(self):
@@ -135,10 +393,12 @@ class CustomImageFolder(Dataset):
         location_label = torch.tensor(self.location_index, dtype=torch.long)
         return img, class_label, location_label """
     
+    def _load_image(self, index: int):
+        return Image.open(str(self.image_paths[index])).convert("RGB")
+
     #NOTE P.V: for CCKD
     def __getitem__(self, index: int) -> Tuple[Any, Any, Any]:
-        img_path = self.image_paths[index]
-        img = Image.open(img_path).convert("RGB")
+        img = self._load_image(index)
 
         if self.transform:
             img = self.transform(img)
@@ -155,12 +415,371 @@ class CustomImageFolder(Dataset):
         }
 
 
+class MemmapImageFolder(CustomImageFolder):
+    """
+    A CustomImageFolder whose images are decoded and preprocessed once and stored in a single (N, 3, H, W) uint8 .npy file in cache_dir. Images are then read from the memory-mapped file instead of being decoded again.
+    preprocess must be deterministic and return uint8 tensors of shape (3, *image_size).
+    The cache file is keyed by the folder's modification time, the selected images, the image size and preprocess.
+    """
+
+    def __init__(
+        self,
+        folder_path,
+        class_index,
+        location_index,
+        cache_dir,
+        limit=None,
+        preprocess=None,
+        image_size=(224, 224),
+    ):
+        super().__init__(
+            folder_path,
+            class_index,
+            location_index,
+            limit=limit,
+        )
+        self.preprocess = preprocess
+        self.image_size = tuple(image_size)
+        key = hashlib.sha1(
+            "\n".join(
+                [
+                    os.path.abspath(folder_path),
+                    str(os.stat(folder_path).st_mtime_ns),
+                    str(self.image_size),
+                    repr(preprocess),
+                ]
+                + self.image_paths.tolist()
+            ).encode()
+        ).hexdigest()
+        self.cache_file = os.path.join(cache_dir, f"{key}.npy")
+        if not os.path.exists(self.cache_file):
+            self._materialize()
+        # opened lazily so that the mapping is not pickled into DataLoader workers
+        self._images = None
+
+    def _materialize(self) -> None:
+        os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+        from torchvision import transforms
+
+        preprocess = self.preprocess
+        if preprocess is None:
+            preprocess = transforms.Compose(
+                [transforms.Resize(self.image_size), transforms.PILToTensor()]
+            )
+        # unique per writer, so that processes materializing the same folder do not collide
+        fd, tmp_file = tempfile.mkstemp(
+            dir=os.path.dirname(self.cache_file), suffix=".npy.tmp"
+        )
+        os.close(fd)
+        try:
+            images = np.lib.format.open_memmap(
+                tmp_file,
+                mode="w+",
+                dtype=np.uint8,
+                shape=(len(self.image_paths), 3, *self.image_size),
+            )
+            for i, img_path in enumerate(self.image_paths):
+                img = Image.open(str(img_path)).convert("RGB")
+                images[i] = preprocess(img).numpy()
+            images.flush()
+            del images
+            os.replace(tmp_file, self.cache_file)
+        except BaseException:
+            os.remove(tmp_file)
+            raise
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_images"] = None
+        return state
+
+    def _load_image(self, index: int) -> torch.Tensor:
+        if self._images is None:
+            self._images = np.load(self.cache_file, mmap_mode="r")
+        return torch.from_numpy(np.array(self._images[index]))
+
+
+class EncodedImageFolder(CustomImageFolder):
+    """
+    A CustomImageFolder that returns the raw encoded file contents as a uint8 tensor, leaving decoding to decode_images on the GPU
+    """
+
+    def _load_image(self, index: int) -> torch.Tensor:
+        from torchvision import io as tvio
+
+        return tvio.read_file(str(self.image_paths[index]))
+
+
+def encoded_collate(batch):
+    """
+    Collates samples of an EncodedImageFolder. Encoded images differ in length, so they are kept as a list.
+    """
+    return {
+        "img": [sample["img"] for sample in batch],
+        "target": torch.stack([sample["target"] for sample in batch]),
+        "location": torch.stack([sample["location"] for sample in batch]),
+    }
+
+
+def _resize_and_center_crop(img, image_size, crop_pct, interpolation):
+    # mirrors gpu_augment_preprocess on a (3, H, W) uint8 tensor
+    height, width = img.shape[1:]
+    if image_size[0] == image_size[1]:
+        # resize the shorter side, keeping the aspect ratio
+        short_size = math.floor(image_size[0] / crop_pct)
+        if height <= width:
+            resize_to = (short_size, int(short_size * width / height))
+        else:
+            resize_to = (int(short_size * height / width), short_size)
+    else:
+        resize_to = tuple(math.floor(s / crop_pct) for s in image_size)
+    if resize_to != (height, width):
+        img = F.interpolate(
+            img[None].float(),
+            size=resize_to,
+            mode=interpolation,
+            align_corners=False,
+            antialias=True,
+        )[0]
+        img = img.round_().clamp_(0, 255)
+    top = int(round((resize_to[0] - image_size[0]) / 2.0))
+    left = int(round((resize_to[1] - image_size[1]) / 2.0))
+    return img[:, top : top + image_size[0], left : left + image_size[1]]
+
+
+def decode_images(
+    data, image_size, device="cuda", crop_pct=1.0, interpolation="bilinear"
+) -> torch.Tensor:
+    """
+    Decodes a list of encoded images into a (B, 3, H, W) uint8 batch on device, resized and centre cropped like gpu_augment_preprocess. JPEGs are decoded with nvJPEG; any other format is decoded on the CPU.
+    """
+    from torchvision import io as tvio
+
+    device = torch.device(device)
+    interpolation = "bicubic" if interpolation == "bicubic" else "bilinear"
+    images = torch.empty(
+        (len(data), 3, *image_size), dtype=torch.uint8, device=device
+    )
+    for i, encoded in enumerate(data):
+        if bytes(encoded[:2].tolist()) == b"\xff\xd8":
+            # decoded one at a time, as batched decode_jpeg needs torchvision 0.19
+            img = tvio.decode_jpeg(encoded, mode=tvio.ImageReadMode.RGB, device=device)
+        else:
+            img = tvio.decode_image(encoded, mode=tvio.ImageReadMode.RGB).to(device)
+        images[i].copy_(
+            _resize_and_center_crop(img, image_size, crop_pct, interpolation)
+        )
+    return images
+
+
+def gpu_augment_preprocess(data_config):
+    """
+    Returns the deterministic CPU part of timm's eval transform for data_config: a resize by crop_pct with the configured interpolation followed by a centre crop, producing uint8 tensors
+    """
+    from torchvision import transforms
+
+    size = tuple(data_config["input_size"][1:])
+    scale_size = tuple(math.floor(s / data_config["crop_pct"]) for s in size)
+    if size[0] == size[1]:
+        # resize the shorter side, keeping the aspect ratio, as timm does
+        scale_size = scale_size[0]
+    return transforms.Compose(
+        [
+            transforms.Resize(
+                scale_size,
+                interpolation=transforms.InterpolationMode(
+                    data_config["interpolation"]
+                ),
+            ),
+            transforms.CenterCrop(size),
+            transforms.PILToTensor(),
+        ]
+    )
+
+
+class BatchTransform(nn.Module):
+    """
+    Converts a batch of uint8 images to normalized floats on the device the batch lives on.
+    With augment, it applies timm's training augmentation to every image independently: a random resized crop, a horizontal flip and colour jitter.
+    Unlike timm, the crop is taken from the centre-cropped image produced by gpu_augment_preprocess rather than from the full-resolution original.
+    """
+
+    def __init__(
+        self,
+        mean,
+        std,
+        augment=False,
+        jitter=0.4,
+        crop_scale=(0.08, 1.0),
+        crop_ratio=(3 / 4, 4 / 3),
+        interpolation="bilinear",
+    ):
+        super().__init__()
+        self.augment = augment
+        self.jitter = jitter
+        self.crop_scale = crop_scale
+        self.crop_ratio = crop_ratio
+        self.interpolation = "bicubic" if interpolation == "bicubic" else "bilinear"
+        self.register_buffer("mean", torch.tensor(mean).view(1, 3, 1, 1))
+        self.register_buffer("std", torch.tensor(std).view(1, 3, 1, 1))
+        self.register_buffer(
+            "gray_weights", torch.tensor([0.299, 0.587, 0.114]).view(1, 3, 1, 1)
+        )
+
+    def _random_factor(self, x: torch.Tensor) -> torch.Tensor:
+        return torch.empty(x.shape[0], 1, 1, 1, device=x.device).uniform_(
+            1 - self.jitter, 1 + self.jitter
+        )
+
+    def _color_jitter(self, x: torch.Tensor) -> torch.Tensor:
+        # brightness
+        x = (x * self._random_factor(x)).clamp_(0, 1)
+        # contrast
+        gray = (x * self.gray_weights).sum(dim=1, keepdim=True)
+        mean = gray.mean(dim=(2, 3), keepdim=True)
+        x = ((x - mean) * self._random_factor(x) + mean).clamp_(0, 1)
+        # saturation
+        gray = (x * self.gray_weights).sum(dim=1, keepdim=True)
+        return ((x - gray) * self._random_factor(x) + gray).clamp_(0, 1)
+
+    def _random_resized_crop_and_flip(self, x: torch.Tensor) -> torch.Tensor:
+        n = x.shape[0]
+        area = torch.empty(n, device=x.device).uniform_(*self.crop_scale)
+        ratio = torch.empty(n, device=x.device).uniform_(
+            math.log(self.crop_ratio[0]), math.log(self.crop_ratio[1])
+        ).exp_()
+        # crop width and height as fractions of the image
+        w = (area * ratio).sqrt_().clamp_(max=1)
+        h = (area / ratio).sqrt_().clamp_(max=1)
+        flip = torch.where(
+            torch.rand(n, device=x.device) < 0.5,
+            -torch.ones(n, device=x.device),
+            torch.ones(n, device=x.device),
+        )
+        theta = torch.zeros(n, 2, 3, device=x.device)
+        theta[:, 0, 0] = w * flip
+        theta[:, 0, 2] = (torch.rand(n, device=x.device) * 2 - 1) * (1 - w)
+        theta[:, 1, 1] = h
+        theta[:, 1, 2] = (torch.rand(n, device=x.device) * 2 - 1) * (1 - h)
+        grid = F.affine_grid(theta, list(x.shape), align_corners=False)
+        x = F.grid_sample(
+            x, grid, mode=self.interpolation, padding_mode="border", align_corners=False
+        )
+        return x.clamp_(0, 1)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        x = x.float().div_(255)
+        if self.augment and self.training:
+            x = self._random_resized_crop_and_flip(x)
+            if self.jitter:
+                x = self._color_jitter(x)
+        return (x - self.mean) / self.std
+
+
+class SpawriousPrefetcher:
+    """
+    Wraps a DataLoader and copies the next batch to the GPU on a side stream while the current batch is in use, applying batch_transform to the images once they are on the device.
+    Use with a loader created with pin_memory=True so that the copies are asynchronous.
+    Batches of encoded images (see encoded_collate) are decoded on the device and resized to image_size with decode_images; SpawriousBenchmark.make_prefetcher fills these arguments in from the model's data config.
+    """
+
+    def __init__(
+        self,
+        loader,
+        batch_transform=None,
+        device="cuda",
+        image_size=None,
+        crop_pct=1.0,
+        interpolation="bilinear",
+    ):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.image_size = None if image_size is None else tuple(image_size)
+        self.crop_pct = crop_pct
+        self.interpolation = interpolation
+        self.batch_transform = batch_transform
+        if batch_transform is not None:
+            self.batch_transform = batch_transform.to(self.device)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _to_device(self, batch):
+        batch = {
+            key: value
+            if isinstance(value, list)
+            else value.to(self.device, non_blocking=True)
+            for key, value in batch.items()
+        }
+        if isinstance(batch["img"], list):
+            if self.image_size is None:
+                raise ValueError("image_size is required to decode encoded images")
+            batch["img"] = decode_images(
+                batch["img"],
+                self.image_size,
+                self.device,
+                crop_pct=self.crop_pct,
+                interpolation=self.interpolation,
+            )
+        if self.batch_transform is not None:
+            batch["img"] = self.batch_transform(batch["img"])
+        return batch
+
+    def __iter__(self):
+        stream = torch.cuda.Stream(device=self.device)
+        first = True
+        for next_batch in self.loader:
+            with torch.cuda.stream(stream):
+                next_batch = self._to_device(next_batch)
+            if not first:
+                yield batch
+            else:
+                first = False
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(stream)
+            # tensors were allocated on the side stream but are used on this one
+            for value in next_batch.values():
+                value.record_stream(current_stream)
+            batch = next_batch
+        if not first:
+            yield batch
+
+
+class FlatConcatDataset(Dataset):
+    """
+    Concatenates datasets behind a single (N, 2) array of (dataset, index within dataset) pairs, so that fetching a sample is one lookup instead of a walk through nested ConcatDatasets.
+    Nested FlatConcatDatasets are flattened into their underlying datasets.
+    """
+
+    def __init__(self, datasets):
+        self.datasets = []
+        for dataset in datasets:
+            if isinstance(dataset, FlatConcatDataset):
+                self.datasets.extend(dataset.datasets)
+            else:
+                self.datasets.append(dataset)
+        sizes = [len(dataset) for dataset in self.datasets]
+        self.index_map = np.empty((sum(sizes), 2), dtype=np.int32)
+        self.index_map[:, 0] = np.repeat(np.arange(len(sizes)), sizes)
+        self.index_map[:, 1] = np.concatenate(
+            [np.arange(size) for size in sizes] or [np.empty(0, dtype=np.int32)]
+        )
+
+    def __len__(self):
+        return len(self.index_map)
+
+    def __getitem__(self, index):
+        dataset_index, sample_index = self.index_map[index]
+        return self.datasets[dataset_index][int(sample_index)]
+
+
 class MultipleDomainDataset:
     N_STEPS = 5001  # Default, subclasses may override
     CHECKPOINT_FREQ = 100  # Default, subclasses may override
     N_WORKERS = 8  # Default, subclasses may override
     ENVIRONMENTS = None  # Subclasses should override
     INPUT_SHAPE = None  # Subclasses should override
+    collate_fn = None  # Default collate, subclasses may override
 
     def __getitem__(self, index):
         return self.datasets[index]
@@ -168,6 +787,25 @@ class MultipleDomainDataset:
     def __len__(self):
         return len(self.datasets)
 
+    def make_loader(self, index, batch_size, training=True, num_workers=None):
+        """
+        Returns a DataLoader over the environment at index, with worker processes kept alive between epochs and batches placed in pinned memory when CUDA is available
+        """
+        if num_workers is None:
+            num_workers = min(self.N_WORKERS, os.cpu_count() or 1)
+        loader_kwargs = {}
+        if num_workers > 0:
+            loader_kwargs.update(persistent_workers=True, prefetch_factor=4)
+        return torch.utils.data.DataLoader(
+            self.datasets[index],
+            batch_size=batch_size,
+            shuffle=training,
+            num_workers=num_workers,
+            pin_memory=torch.cuda.is_available(),
+            collate_fn=self.collate_fn,
+            **loader_kwargs,
+        )
+
 
 def build_combination(benchmark_type, group, test, filler=None):
     total = 3168
@@ -207,6 +845,12 @@ def build_combination(benchmark_type, group, test, filler=None):
     return combinations
 
 
+# The returned dict is shared between all callers in the process and must not be modified.
+@functools.lru_cache(maxsize=None)
+def _cached_combination(benchmark_type, group, test, filler):
+    return build_combination(benchmark_type, group, test, filler)
+
+
 def _get_combinations(benchmark_type: str) -> Tuple[dict, dict]:
     combinations = {
         "o2o_easy": (
@@ -243,7 +887,7 @@ def _get_combinations(benchmark_type: str) -> Tuple[dict, dict]:
     if benchmark_type not in combinations:
         raise ValueError("Invalid benchmark type")
     group, test, filler = combinations[benchmark_type]
-    return build_combination(benchmark_type, group, test, filler), filler
+    return _cached_combination(benchmark_type, tuple(group), tuple(test), filler), filler
 
 
 class SpawriousBenchmark(MultipleDomainDataset):
@@ -253,8 +897,25 @@ class SpawriousBenchmark(MultipleDomainDataset):
     class_list = ["bulldog", "corgi", "dachshund", "labrador"]
     locations_list = ["desert", "jungle", "dirt", "mountain", "snow", "beach"]
 
-    def __init__(self, benchmark, root_dir, augment=True, disable_transform = False):
+    def __init__(
+        self,
+        benchmark,
+        root_dir,
+        augment=True,
+        disable_transform=False,
+        gpu_augment=False,
+        materialize=False,
+        gpu_decode=False,
+    ):
+        if (materialize or gpu_decode) and not gpu_augment:
+            raise ValueError("materialize and gpu_decode require gpu_augment")
+        if materialize and gpu_decode:
+            raise ValueError("materialize and gpu_decode are mutually exclusive")
         self.disable_transform = disable_transform
+        self.gpu_augment = gpu_augment
+        self.materialize = materialize
+        self.gpu_decode = gpu_decode
+        self.collate_fn = encoded_collate if gpu_decode else None
         combinations, filler = _get_combinations(benchmark.lower())
         self.filler = filler
         self.combinations = combinations
@@ -265,7 +926,7 @@ class SpawriousBenchmark(MultipleDomainDataset):
             root_dir,
             augment,
         )
-        self.datasets = [ConcatDataset(test_datasets)] + train_datasets
+        self.datasets = [FlatConcatDataset(test_datasets)] + train_datasets
 
 
     def get_filler_location_index(self): 
@@ -275,11 +936,12 @@ class SpawriousBenchmark(MultipleDomainDataset):
             return -1
 
     def get_combinations(self): 
-        return self.combinations
+        # self.combinations is shared with other benchmarks, see _cached_combination
+        return copy.deepcopy(self.combinations)
     
 
     def get_train_dataset(self):
-        return torch.utils.data.ConcatDataset(self.datasets[1:])
+        return FlatConcatDataset(self.datasets[1:])
 
     def get_test_dataset(self):
         return self.datasets[0]
@@ -291,10 +953,31 @@ class SpawriousBenchmark(MultipleDomainDataset):
     def get_test_transform(self): 
         return self.test_transform
 
+    def get_train_batch_transform(self):
+        return self.train_batch_transform
+
+    def get_test_batch_transform(self):
+        return self.test_batch_transform
+
+    def make_prefetcher(self, loader, training=True, device="cuda"):
+        """
+        Returns a SpawriousPrefetcher for loader that applies this benchmark's batch transform and, with gpu_decode, decodes images to the model's input size
+        """
+        return SpawriousPrefetcher(
+            loader,
+            self.train_batch_transform if training else self.test_batch_transform,
+            device=device,
+            image_size=self.input_size,
+            crop_pct=self.data_config["crop_pct"],
+            interpolation=self.data_config["interpolation"],
+        )
+
     # Prepares the train and test data lists by applying the necessary transformations.
     def _prepare_data_lists(
         self, train_combinations, test_combinations, root_dir, augment
     ):
+        import timm
+
         backbone = timm.create_model(
             # "vit_so400m_patch14_siglip_384",
             MODEL_NAME,
@@ -302,6 +985,7 @@ class SpawriousBenchmark(MultipleDomainDataset):
             num_classes=0,
         ).eval()
         self.data_config = timm.data.resolve_model_data_config(backbone)
+        self.input_size = tuple(self.data_config["input_size"][1:])
         test_transforms = timm.data.create_transform(
             **self.data_config, is_training=False
         )
@@ -322,6 +1006,23 @@ class SpawriousBenchmark(MultipleDomainDataset):
         else:
             train_transforms = test_transforms
 
+        self.train_batch_transform = None
+        self.test_batch_transform = None
+        if self.gpu_augment:
+            # only resize and centre crop on the CPU; augmentation and
+            # normalization run on whole batches once they are on the GPU
+            test_transforms = gpu_augment_preprocess(self.data_config)
+            train_transforms = test_transforms
+            self.train_batch_transform = BatchTransform(
+                self.data_config["mean"],
+                self.data_config["std"],
+                augment=augment,
+                interpolation=self.data_config["interpolation"],
+            )
+            self.test_batch_transform = BatchTransform(
+                self.data_config["mean"], self.data_config["std"]
+            )
+
         
         if not self.disable_transform:
             train_data_list = self._create_data_list(
@@ -344,42 +1045,79 @@ class SpawriousBenchmark(MultipleDomainDataset):
 
         return train_data_list, test_data_list
 
+    # Creates the dataset for a single class folder, backed by a memory-mapped cache if requested.
+    def _make_image_folder(self, path, cls, location, limit, root_dir, transforms):
+        if self.materialize:
+            return MemmapImageFolder(
+                folder_path=path,
+                class_index=self.class_list.index(cls),
+                location_index=self.locations_list.index(location),
+                limit=limit,
+                preprocess=transforms,
+                cache_dir=os.path.join(root_dir, "spawrious224", ".cache"),
+                image_size=self.data_config["input_size"][1:],
+            )
+        if self.gpu_decode:
+            return EncodedImageFolder(
+                folder_path=path,
+                class_index=self.class_list.index(cls),
+                location_index=self.locations_list.index(location),
+                limit=limit,
+            )
+        return CustomImageFolder(
+            folder_path=path,
+            class_index=self.class_list.index(cls),
+            location_index=self.locations_list.index(location),
+            limit=limit,
+            transform=transforms,
+        )
+
     # Creates a list of datasets based on the given combinations and transformations.
     def _create_data_list(self, combinations, root_dir, transforms):
         data_list = []
         if isinstance(combinations, dict):
-            # Build class groups for a given set of combinations, root directory, and transformations.
-            for_each_class_group = []
-            cg_index = 0
+            # Collect the folders to load, so that their directory scans can run in parallel.
+            tasks = []
             for classes, comb_list in combinations.items():
-                for_each_class_group.append([])
                 for ind, location_limit in enumerate(comb_list):
                     if isinstance(location_limit, tuple):
                         location, limit = location_limit
                     else:
                         location, limit = location_limit, None
-                    cg_data_list = []
                     for cls in classes:
                         path = os.path.join(
                             root_dir,
                             "spawrious224",
                             f"{0 if not self.type1 else ind}/{location}/{cls}",
                         )
-                        data = CustomImageFolder(
-                            folder_path=path,
-                            class_index=self.class_list.index(cls),
-                            location_index=self.locations_list.index(location),
-                            limit=limit,
-                            transform=transforms,
+                        tasks.append((path, cls, location, limit))
+            with ThreadPoolExecutor(max_workers=min(16, len(tasks))) as executor:
+                folders = iter(
+                    list(
+                        executor.map(
+                            lambda task: self._make_image_folder(
+                                *task, root_dir, transforms
+                            ),
+                            tasks,
                         )
-                        cg_data_list.append(data)
+                    )
+                )
 
-                    for_each_class_group[cg_index].append(ConcatDataset(cg_data_list))
+            # Build class groups for a given set of combinations, root directory, and transformations.
+            for_each_class_group = []
+            cg_index = 0
+            for classes, comb_list in combinations.items():
+                for_each_class_group.append([])
+                for _ in comb_list:
+                    cg_data_list = [next(folders) for _ in classes]
+                    for_each_class_group[cg_index].append(
+                        FlatConcatDataset(cg_data_list)
+                    )
                 cg_index += 1
 
             for group in range(len(for_each_class_group[0])):
                 data_list.append(
-                    ConcatDataset(
+                    FlatConcatDataset(
                         [
                             for_each_class_group[k][group]
                             for k in range(len(for_each_class_group))
@@ -387,6 +1125,8 @@ class SpawriousBenchmark(MultipleDomainDataset):
                     )
                 )
         else:
+            from torchvision.datasets import ImageFolder
+
             for location in combinations:
                 path = os.path.join(root_dir, f"{0}/{location}/")
                 data = ImageFolder(root=path, transform=transforms)
@@ -395,6 +1135,14 @@ class SpawriousBenchmark(MultipleDomainDataset):
         return data_list
 
 
+def _has_images(path: str) -> bool:
+    # os.scandir yields entries lazily, so the directory is only read up to the first image
+    with os.scandir(path) as entries:
+        return any(
+            entry.name.endswith((".png", ".jpg", ".jpeg")) for entry in entries
+        )
+
+
 def _check_images_availability(root_dir: str, dataset_type: str) -> bool:
     # Get the combinations for the given dataset type
     root_dir = root_dir.split("/spawrious224/")[
@@ -407,10 +1155,7 @@ def _check_images_availability(root_dir: str, dataset_type: str) -> bool:
                     path = os.path.join(
                         root_dir, "spawrious224", f"{dataset}/{location}/{cls}"
                     )
-                    if not os.path.exists(path) or not any(
-                        img.endswith((".png", ".jpg", ".jpeg"))
-                        for img in os.listdir(path)
-                    ):
+                    if not os.path.exists(path) or not _has_images(path):
                         return False
         return True
     combinations, _ = _get_combinations(dataset_type.lower())
@@ -436,21 +1181,34 @@ def _check_images_availability(root_dir: str, dataset_type: str) -> bool:
                     )
 
                     # If the path does not exist or there are no relevant images, return False
-                    if not os.path.exists(path) or not any(
-                        img.endswith((".png", ".jpg", ".jpeg"))
-                        for img in os.listdir(path)
-                    ):
+                    if not os.path.exists(path) or not _has_images(path):
                         return False
 
     # If all the required images are present, return True
     return True
 
 
-def get_spawrious_dataset(root_dir: str, dataset_name: str = "entire_dataset", augment = True, disable_transform = False):
+def get_spawrious_dataset(
+    root_dir: str,
+    dataset_name: str = "entire_dataset",
+    augment=True,
+    disable_transform=False,
+    gpu_augment=False,
+    materialize=False,
+    gpu_decode=False,
+    keep_tar=False,
+):
     """
     Returns the dataset as a torch dataset, and downloads dataset if dataset is not already available.
 
     By default, the entire dataset is downloaded, which is necessary for m2m experiments, and domain adaptation experiments
+
+    By default, the tarball is extracted while it streams in and is never stored. With keep_tar, it is instead downloaded over parallel connections, kept in root_dir and extracted afterwards.
+
+    With gpu_augment, images are only resized and centre cropped on the CPU, as in timm's eval transform, and returned as uint8 tensors. Batches must then be passed through get_train_batch_transform() or get_test_batch_transform() after being moved to the GPU.
+    The training augmentation then crops from the centre-cropped image instead of the full original, so results are close to, but not identical with, the default path.
+    With materialize (which requires gpu_augment), the resized images are additionally cached once as memory-mapped uint8 arrays under root_dir/spawrious224/.cache, so later epochs and runs skip JPEG decoding.
+    With gpu_decode (which also requires gpu_augment), the datasets return the encoded image files instead. Load them with the dataset's collate_fn and decode them on the GPU with SpawriousPrefetcher.
     """
     root_dir = root_dir.split("/spawrious224/")[
         0
@@ -465,6 +1223,16 @@ def get_spawrious_dataset(root_dir: str, dataset_name: str = "entire_dataset", a
         "m2m",
         "entire_dataset",
     }, f"Invalid dataset type: {dataset_name}"
-    _download_dataset_if_not_available(dataset_name, root_dir)
+    _download_dataset_if_not_available(
+        dataset_name, root_dir, remove_tar_after_extracting=not keep_tar
+    )
     # TODO: get m2m to use entire dataset, not half of it
-    return SpawriousBenchmark(dataset_name, root_dir, augment=augment, disable_transform=disable_transform)
+    return SpawriousBenchmark(
+        dataset_name,
+        root_dir,
+        augment=augment,
+        disable_transform=disable_transform,
+        gpu_augment=gpu_augment,
+        materialize=materialize,
+        gpu_decode=gpu_decode,
+    )